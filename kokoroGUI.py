@@ -6,12 +6,40 @@ from kokoro import KPipeline
 import soundfile as sf
 import sounddevice as sd
 import threading
+import os
+import re
+from queue import Queue
 import time
 import gc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
 import torch
 
+# Give torch's intra-op pool half the logical cores (roughly one per physical core)
+# instead of one per logical core, which oversubscribes on the small tensors TTS
+# works on, and a single inter-op thread. Set at import because
+# set_num_interop_threads() fails once any parallel work has run.
+torch.set_num_threads(max(1, (os.cpu_count() or 1) // 2))
+torch.set_num_interop_threads(1)
+# Allow TF32 Tensor Core math on Ampere+.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+
+def copy_block(buf, pos, end, out):
+    """Copies buf[pos:end] into out (zero-filling the rest) and returns the number of samples copied."""
+    n = min(end - pos, out.shape[0])
+    out[:n] = buf[pos:pos + n]
+    out[n:] = 0
+    return n
+
 
 class KokoroGUI:
+    # CPU and CUDA pipelines stay loaded so toggling the device doesn't reload the model.
+    MAX_CACHED_PIPELINES = 2
+
     def __init__(self, root):
         self.root = root
         self.root.title("Kokoro Text-to-Speech")
@@ -26,8 +54,9 @@ class KokoroGUI:
         ttk.Radiobutton(self.device_frame, text="CPU", variable=self.device_var, value='cpu').pack(side="left", padx=5, pady=5)
         ttk.Radiobutton(self.device_frame, text="CUDA", variable=self.device_var, value='cuda').pack(side="left", padx=5, pady=5)
 
-        # Voice selection
+        # Voice selection (with callback)
         self.voice_var = tk.StringVar(value='af_heart')
+        self.voice_var.trace_add("write", self.on_voice_change)
         self.voice_frame = ttk.LabelFrame(self.root, text="Voice Selection")
         self.voice_frame.pack(fill="x", padx=10, pady=5)
         self.voice_dropdown = ttk.Combobox(self.voice_frame, textvariable=self.voice_var, state="readonly")
@@ -61,16 +90,23 @@ class KokoroGUI:
         self.exit_button.pack(side="right", padx=5, pady=5)
 
         # Audio control variables
-        self.audio_thread = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
         self.is_playing = False
         self.is_paused = False
-        self.stop_playback = False
+        # Cancel Event of the current Play; each run gets its own so a late job can't be revived.
+        self._cancel = threading.Event()
         self.audio_data = None
+        self.write_position = 0
+        self.synthesis_done = False
+        self._done = threading.Event()
         self.current_position = 0
         self.start_timestamp = 0
         self.accumulated_time = 0
-        self.stream = None
         self.pipeline = None
+        self._pipelines = OrderedDict()
+        self._voices = {}
+        # One warm-up Event per cached pipeline, keyed by device like _pipelines.
+        self._warmed = {}
 
       
         self.initialize_pipeline()
@@ -86,24 +122,69 @@ class KokoroGUI:
         self.root.geometry(f"{width}x{height}+{x}+{y}")
 
     def initialize_pipeline(self):
-        """Initializes or re-initializes the KPipeline."""
-        self.clear_pipeline() 
+        """Activates the KPipeline for the selected device, loading it on first use."""
+        self.pipeline = None
         try:
-            self.pipeline = KPipeline(lang_code='a', device=self.device_var.get())
+            self.pipeline = self.get_pipeline(self.device_var.get())
         except RuntimeError as e:
             if "No CUDA GPUs are available" in str(e):
                 messagebox.showerror("CUDA Error", "No CUDA GPUs are available.  Switching to CPU.")
                 self.device_var.set('cpu')  # Switch to CPU
-                self.pipeline = KPipeline(lang_code='a', device='cpu')
+                self.pipeline = self.get_pipeline('cpu')
             else:
                 messagebox.showerror("Initialization Error", str(e))
         except Exception as e:
             messagebox.showerror("Initialization Error", str(e))
 
+    def get_pipeline(self, device):
+        """Returns the cached KPipeline for a device, building and warming it up if needed."""
+        if device in self._pipelines:
+            self._pipelines.move_to_end(device)
+            return self._pipelines[device]
+
+        pipeline = KPipeline(lang_code='a', device=device)
+        # Voicepacks are kept on the host and moved per call, so all pipelines can share
+        # one cache and a device switch never re-reads them from disk.
+        pipeline.voices = self._voices
+        self._pipelines[device] = pipeline
+        if len(self._pipelines) > self.MAX_CACHED_PIPELINES:
+            evicted, _ = self._pipelines.popitem(last=False)
+            self._warmed.pop(evicted, None)
+            if evicted == 'cuda':
+                torch.cuda.empty_cache()
+            gc.collect()
+
+        warmed = self._warmed[device] = threading.Event()
+        threading.Thread(target=self._warmup, args=(pipeline, self.voice_var.get(), warmed),
+                         daemon=True).start()
+        return pipeline
+
+    def _warmup(self, pipeline, voice, warmed):
+        """Runs a throwaway synthesis so kernel selection and voice loading happen before the first Play."""
+        try:
+            with torch.inference_mode():
+                for _ in pipeline("Hello world.", voice=voice, speed=1.0, split_pattern=r'\n+'):
+                    pass
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+        finally:
+            warmed.set()
+
     def on_device_change(self, *args):
         """Handles device changes immediately."""
         self.initialize_pipeline()
 
+    def on_voice_change(self, *args):
+        """Preloads the new voicepack in the background; the model itself is left as is."""
+        if self.pipeline:
+            threading.Thread(target=self._load_voice, args=(self.pipeline, self.voice_var.get()), daemon=True).start()
+
+    def _load_voice(self, pipeline, voice):
+        try:
+            pipeline.load_voice(voice)  # memoized by KPipeline per voice name
+        except Exception as e:
+            print(f"Failed to preload voice {voice}: {e}")
+
 
     def play_audio(self):
         if self.is_playing:
@@ -115,69 +196,169 @@ class KokoroGUI:
             messagebox.showwarning("Warning", "Please enter some text.")
             return
 
+        if not self.pipeline:
+            messagebox.showwarning("Warning", "No pipeline is loaded.")
+            return
+
         self.play_button.config(state="disabled")
         self.is_playing = True
         self.is_paused = False
-        self.stop_playback = False
+        cancel = self._cancel = threading.Event()
 
         device = self.device_var.get()
         voice = self.voice_var.get()
         speed = self.speed_var.get()
+        pipeline = self.pipeline
+        warmed = self._warmed[device]
 
-        self.audio_thread = threading.Thread(target=self.generate_and_play_audio, args=(text, device, voice, speed))
-        self.audio_thread.start()
+        future = self.executor.submit(self.generate_and_play_audio, text, device, voice, speed, pipeline, warmed,
+                                      cancel)
+        self.root.after(50, self.poll_audio, future)
 
-    def generate_and_play_audio(self, text, device, voice, speed):
-       
-        generator = self.pipeline(text, voice=voice, speed=speed, split_pattern=r'\n+')
+    def poll_audio(self, future):
+        """Checks one job's future from the Tk loop and restores the UI once it finishes."""
+        if not future.done():
+            self.root.after(50, self.poll_audio, future)
+            return
+        self.play_button.config(state="normal")
+        error = future.exception()
+        if error:
+            messagebox.showerror("Error", f"An error occurred: {error}")
 
-        self.audio_data = []
+    def generate_and_play_audio(self, text, device, voice, speed, pipeline, warmed, cancel):
+       
+        # KModel only runs one sequence per forward, so lines can't be batched; split
+        # them up front and drop blank ones so each pipeline step is real work.
+        lines = [line for line in re.split(r'\n+', text) if line.strip()]
+        generator = pipeline(lines, voice=voice, speed=speed)
+
+        # Chunks are written into one preallocated buffer as soon as they are synthesized
+        # and the callback plays up to the write cursor, so playback starts after the
+        # first split. The estimate is generous (~0.1 s per character) to avoid regrowth.
+        self.audio_data = np.empty(int(len(text) * 24000 * 0.1 / speed) + 24000, dtype=np.int16)
+        self.write_position = 0
+        self.synthesis_done = False
+        self._done.clear()
+        stream = None
+        # The model runs on its own thread so chunk i+1 is synthesized while chunk i
+        # is copied to the host and quantized here, and played by the callback.
+        chunks = Queue(maxsize=4)
         try:
-            for i, (gs, ps, audio) in enumerate(generator):
-                if self.stop_playback:
+            if cancel.is_set():
+                return  # stopped before this job got the worker
+            self.current_position = 0
+            self.accumulated_time = 0
+            self.start_timestamp = time.time()
+
+            # Don't compete with this pipeline's warm-up if it is still running. The stream
+            # only opens afterwards so its callback doesn't spin through the wait.
+            warmed.wait()
+            if cancel.is_set():
+                return
+
+            stream = sd.RawOutputStream(
+                samplerate=24000,
+                channels=1,
+                dtype='int16',
+                callback=partial(self.audio_callback_i16, cancel=cancel),
+                finished_callback=self._done.set,  # also releases the worker if PortAudio aborts
+                blocksize=1024
+            )
+            stream.start()
+
+            threading.Thread(target=self.synthesize, args=(generator, chunks, cancel), daemon=True).start()
+            while True:
+                audio = chunks.get()
+                if audio is None:
+                    break
+                if isinstance(audio, Exception):
+                    raise audio
+                if cancel.is_set():
                     break
-                self.audio_data.append(audio)
-
-            if not self.stop_playback:
-                self.audio_data = [item for sublist in self.audio_data for item in sublist]
-                self.audio_data = [float(x) for x in self.audio_data]
-
-                self.current_position = 0
-                self.accumulated_time = 0
-                self.start_timestamp = time.time()
-
-                self.stream = sd.OutputStream(
-                    samplerate=24000,
-                    channels=1,
-                    callback=self.audio_callback,
-                    blocksize=1024
-                )
-                self.stream.start()
-                while self.current_position < len(self.audio_data) and not self.stop_playback:
-                    sd.sleep(10)
-                if self.stream:
-                    self.stream.stop()
-                    self.stream.close()
-                    self.stream = None
+                self.append_audio(self.chunk_to_host(audio))
+            if cancel.is_set():
+                # Stopped mid-text: drop what was buffered rather than keep it for nothing.
+                self.audio_data = None
+                self.write_position = 0
+                return
+            self.audio_data = self.audio_data[:self.write_position]
+            self.synthesis_done = True
+
+            # Set by the callback once the last sample is out, by stop_audio, or when the
+            # stream ends for any other reason.
+            self._done.wait()
 
+        finally:
+            # Releases the synthesis thread if this worker leaves early: it sees the
+            # Event before its next forward pass, and draining wakes a blocked put.
+            cancel.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+            if stream is not None:
+                stream.stop()
+                stream.close()
+            if self._cancel is cancel:
+                self.is_playing = False
+
+    def synthesize(self, generator, chunks, cancel):
+        """Iterates the pipeline, queueing raw chunks and then None, or the exception that stopped it."""
+        result = None
+        try:
+            # No autograd bookkeeping during synthesis.
+            with torch.inference_mode():
+                # Checked before every next(), i.e. before each forward pass.
+                while not cancel.is_set():
+                    try:
+                        gs, ps, audio = next(generator)
+                    except StopIteration:
+                        break
+                    chunks.put(audio)
         except Exception as e:
-            messagebox.showerror("Error", f"An error occurred: {e}")
+            result = e
         finally:
-            self.is_playing = False
-            self.root.after(0, lambda: self.play_button.config(state="normal"))
-
-    def audio_callback(self, outdata, frames, time_info, status):
+            # KPipeline has no cancel hook; closing the generator releases its state
+            # (and any chunk tensors it still holds) as soon as Stop is seen.
+            generator.close()
+        chunks.put(result)
+
+    def chunk_to_host(self, audio):
+        """Returns a synthesized chunk as a flat host float32 tensor."""
+        # A single transfer+cast; a no-op for the host float32 tensors KModel returns.
+        return torch.as_tensor(audio).reshape(-1).to('cpu', dtype=torch.float32)
+
+    def append_audio(self, audio):
+        """Quantizes a float chunk to int16 into the playback buffer and publishes it to the callback."""
+        w = self.write_position
+        n = len(audio)
+        buf = self.audio_data
+        if w + n > len(buf):
+            buf = np.empty(max(w + n, int(len(buf) * 1.5)), dtype=np.int16)
+            buf[:w] = self.audio_data[:w]
+        # Scale, clamp and cast in torch, writing straight into the buffer through a shared view.
+        torch.from_numpy(buf[w:w + n]).copy_(audio.mul(32767).clamp_(-32768, 32767))
+        # Swap the buffer in before advancing the cursor; the callback reads them in reverse order.
+        self.audio_data = buf
+        self.write_position = w + n
+
+    def audio_callback_i16(self, outdata, frames, time_info, status, cancel):
         if status:
             print(status)
-        if self.is_paused or self.stop_playback:
-            outdata[:] = 0
+        # RawOutputStream hands over a plain buffer; view it as mono int16 samples.
+        out = np.frombuffer(outdata, dtype=np.int16)
+        if self.is_paused or cancel.is_set():
+            out.fill(0)
             return
 
-        chunksize = min(len(self.audio_data) - self.current_position, frames)
-        outdata[:chunksize, 0] = self.audio_data[self.current_position:self.current_position + chunksize]
-        if chunksize < frames:
-            outdata[chunksize:, 0] = 0
-        self.current_position += chunksize
+        # Runs on PortAudio's real-time thread: bind state to locals once. The done flag
+        # is read before the write cursor, and the cursor before the buffer, so neither
+        # the last chunk nor a concurrent regrowth is ever missed.
+        synthesis_done = self.synthesis_done
+        end = self.write_position
+        buf = self.audio_data
+        pos = self.current_position
+        self.current_position = pos + copy_block(buf, pos, end, out)
+        if synthesis_done and self.current_position >= end:
+            self._done.set()
 
     def pause_resume_audio(self):
         if not self.is_playing:
@@ -195,11 +376,9 @@ class KokoroGUI:
 
     def stop_audio(self):
         if self.is_playing:
-            self.stop_playback = True
-            if self.stream:
-                self.stream.stop()
-                self.stream.close()
-                self.stream = None
+            self._cancel.set()
+            # The worker owns the stream and closes it once it wakes up.
+            self._done.set()
             self.is_playing = False
             self.is_paused = False
             self.current_position = 0
@@ -208,15 +387,17 @@ class KokoroGUI:
          
 
     def clear_pipeline(self):
-        if self.pipeline:
-            del self.pipeline
+        if self._pipelines:
+            self._pipelines.clear()
+            self._warmed.clear()
             self.pipeline = None
-            if self.device_var.get() == 'cuda':
+            if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             gc.collect()
 
     def on_exit(self):
         self.stop_audio()
+        self.executor.shutdown(wait=False)
         self.clear_pipeline()
         self.root.destroy()
 